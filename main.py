@@ -1,48 +1,233 @@
 from dotenv import load_dotenv
 from flask import Flask, request, abort
+import orjson
+import linebot.webhook
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
+import logging
 import os
+import threading
 import uuid
-from transformers import pipeline
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from src.batcher import DynamicBatcher
+from src.http_client import PooledRequestsHttpClient
 from src.memory import Memory
+from src.models import OpenAIModel
 from src.logger import logger
-from src.storage import Storage, FileStorage
-from src.utils import get_role_and_content
+from src.storage import Storage, SQLiteStorage
+from src.utils import s2t_converter
 
 # 載入 .env 設定
 load_dotenv('.env')
 
-# 初始化 Hugging Face 模型
+# webhook body 的 json.loads 改用 orjson（只影響 linebot.webhook 模組內的解析）
+linebot.webhook.json = orjson
+
 HF_TOKEN = os.getenv("HUGGINGFACE_API_KEY", "")
-chat_model = pipeline(
-    "text-generation",
-    model="mistralai/Mistral-7B-Instruct",
-    tokenizer="mistralai/Mistral-7B-Instruct",
-    use_auth_token=HF_TOKEN,
-    max_length=512,
-    temperature=0.7,
-    do_sample=True
+MODEL_NAME = "mistralai/Mistral-7B-Instruct"
+
+# 設定 LLM_BASE_URL 時推論改走外部 vLLM / TGI 伺服器（OpenAI 相容端點），
+# 由伺服器端做 continuous batching / PagedAttention；否則在本機載入模型
+LLM_BASE_URL = os.getenv('LLM_BASE_URL')
+
+if LLM_BASE_URL:
+    remote_model = OpenAIModel(api_key=os.getenv('LLM_API_KEY', 'EMPTY'), base_url=LLM_BASE_URL)
+    remote_pool = ThreadPoolExecutor(max_workers=int(os.getenv('MAX_BATCH_SIZE', 8)))
+
+    def _generate_remote(request):
+        # 每筆 HTTP 呼叫彼此獨立，失敗以 Exception 物件回傳，
+        # 由 batcher 逐筆 set_exception，不拖垮同批其他使用者
+        _, prompt = request
+        try:
+            is_successful, response, error_message = remote_model.chat_completions(
+                [{'role': 'user', 'content': prompt}],
+                os.getenv('LLM_MODEL_ENGINE', MODEL_NAME)
+            )
+            if not is_successful:
+                raise Exception(error_message)
+            return response['choices'][0]['message']['content']
+        except Exception as e:
+            return e
+
+    def generate_replies(requests):
+        """把一批 prompt 同時送往推論伺服器，批次合併交給伺服器處理"""
+        return list(remote_pool.map(_generate_remote, requests))
+else:
+    # 要在 import torch 前設定，OpenMP 才會吃到
+    os.environ.setdefault('OMP_NUM_THREADS', str(max(1, (os.cpu_count() or 1) // int(os.getenv('WEB_CONCURRENCY', 1)))))
+
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+    from src.prefix_cache import PrefixKVCache
+
+    # 限制 PyTorch 的 CPU 執行緒數，避免與 web worker 互搶 CPU
+    torch.set_num_threads(int(os.environ['OMP_NUM_THREADS']))
+    torch.set_num_interop_threads(1)
+
+    # 初始化 Hugging Face 模型（直接載入 tokenizer / model，避免 pipeline 每次呼叫的額外開銷）
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, use_auth_token=HF_TOKEN)
+    tokenizer.padding_side = 'left'
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    # NF4 量化：權重頻寬約降為 1/4，7B 模型可塞進 16 GB GPU
+    quantization_config = BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.bfloat16
+    )
+    model_kwargs = dict(
+        use_auth_token=HF_TOKEN,
+        quantization_config=quantization_config if torch.cuda.is_available() else None,
+        device_map="auto",
+        torch_dtype=torch.bfloat16
+    )
+    # FlashAttention-2 融合 attention kernel，長 context 的 decode 明顯較快
+    attn_implementation = os.getenv('ATTN_IMPLEMENTATION', 'flash_attention_2' if torch.cuda.is_available() else 'sdpa')
+    try:
+        model = AutoModelForCausalLM.from_pretrained(MODEL_NAME, attn_implementation=attn_implementation, **model_kwargs)
+    except (ImportError, ValueError):
+        # 未安裝 flash-attn 時退回 PyTorch 內建的 SDPA kernel
+        model = AutoModelForCausalLM.from_pretrained(MODEL_NAME, attn_implementation='sdpa', **model_kwargs)
+    model.eval()
+
+    # 每位使用者上一輪 prompt 的 KV cache，讓下一輪只 prefill 新增的訊息
+    prefix_cache = PrefixKVCache(max_entries=int(os.getenv('PREFIX_CACHE_SIZE', 8)))
+
+    GENERATION_KWARGS = dict(
+        max_new_tokens=256,
+        temperature=0.7,
+        do_sample=True,
+        use_cache=True,
+    )
+
+    def _generate_single(user_id, prompt):
+        """單筆推論，嘗試沿用該使用者上一輪的 KV cache（user_id 為 None 時不快取）"""
+        inputs = tokenizer(prompt, return_tensors='pt').to(model.device)
+        past = prefix_cache.match(user_id, inputs['input_ids']) if user_id else None
+        if past is not None:
+            logger.debug(f'prefix cache hit: {user_id}')
+        with torch.inference_mode():
+            outputs = model.generate(
+                **inputs,
+                **GENERATION_KWARGS,
+                past_key_values=past,
+                pad_token_id=tokenizer.pad_token_id,
+                return_dict_in_generate=True
+            )
+        # 只快取 prompt 部分的 KV：生成的回覆（含結尾 EOS）經過 s2t 轉換、
+        # strip 後才進下一輪 prompt，重新 tokenize 不會等於生成的 token 序列
+        prompt_len = inputs['input_ids'].shape[1]
+        past_out = outputs.past_key_values
+        if user_id and past_out is not None and hasattr(past_out, 'crop'):
+            past_out.crop(prompt_len)
+            prefix_cache.put(user_id, inputs['input_ids'], past_out)
+        new_tokens = outputs.sequences[:, prompt_len:]
+        return tokenizer.batch_decode(new_tokens, skip_special_tokens=True)[0]
+
+    def generate_replies(requests):
+        """對一批 (user_id, prompt) 產生回覆，只回傳新生成的部分"""
+        if len(requests) == 1:
+            user_id, prompt = requests[0]
+            return [_generate_single(user_id, prompt)]
+
+        prompts = [prompt for _, prompt in requests]
+        inputs = tokenizer(prompts, return_tensors='pt', padding=True).to(model.device)
+        with torch.inference_mode():
+            outputs = model.generate(
+                **inputs,
+                **GENERATION_KWARGS,
+                pad_token_id=tokenizer.pad_token_id
+            )
+        # 只解碼 prompt 之後新生成的 token
+        new_tokens = outputs[:, inputs['input_ids'].shape[1]:]
+        return tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+
+
+# 動態合併同時進來的 webhook 請求，一次送進 GPU
+batcher = DynamicBatcher(
+    generate_replies,
+    max_batch_size=int(os.getenv('MAX_BATCH_SIZE', 8)),
+    max_batch_delay=float(os.getenv('MAX_BATCH_DELAY_MS', 40)) / 1000
 )
 
 # 初始化 LINE
 app = Flask(__name__)
-line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
+line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'), timeout=10, http_client=PooledRequestsHttpClient)
 handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
 
 # 教學語氣
 DEFAULT_SYSTEM_MESSAGE = os.getenv('SYSTEM_MESSAGE', '你是一位非常有耐心又擅長教學的老師，懂得用比喻幫助學生理解，尤其擅長處理初學者的問題。')
+SUMMARY_MESSAGE_FORMAT = "下面是一段對話紀錄：\"\"\"{}\"\"\" \n\n請總結出這段對話的重點，字數約 100 字左右"
+
+# 先用 reply 回佔位訊息、生成完成後再 push 完整回答（需要 push message 額度）
+STREAMING_REPLY = os.getenv('STREAMING_REPLY', '1') == '1'
+THINKING_MESSAGE = os.getenv('THINKING_MESSAGE', '思考中...')
+push_pool = ThreadPoolExecutor(max_workers=4)
+
+# 狀態與記憶體（只保留最近 K 輪，更舊的對話以摘要代替）
+storage = Storage(SQLiteStorage('db.sqlite'))
+memory = Memory(system_message=DEFAULT_SYSTEM_MESSAGE, memory_message_count=int(os.getenv('MEMORY_MESSAGE_COUNT', 3)))
 
-# 狀態與記憶體
-storage = Storage(FileStorage('db.json'))
-memory = Memory(system_message=DEFAULT_SYSTEM_MESSAGE, memory_message_count=2)
+# 滑出視窗的舊訊息摘要；還沒併入摘要前，剛滑出的訊息先以原文帶在 prompt 裡
+summaries = defaultdict(str)
+pending_dropped = defaultdict(list)
+summary_lock = threading.Lock()
+summarizing = set()
+
+
+def update_summary(user_id):
+    """在背景把已滑出視窗的訊息併入滾動摘要，不佔用回覆路徑"""
+    with summary_lock:
+        if user_id in summarizing:
+            return
+        dropped = list(pending_dropped[user_id])
+        if not dropped:
+            return
+        summarizing.add(user_id)
+        old_summary = summaries[user_id]
+    try:
+        history = "\n".join(filter(None, [old_summary] + [m["content"] for m in dropped]))
+        summary_prompt = SUMMARY_MESSAGE_FORMAT.format(history)
+        # user_id 傳 None：摘要 prompt 彼此沒有共同前綴，不值得佔 KV cache
+        summary = batcher.submit((None, summary_prompt)).result(timeout=60).strip()
+        with summary_lock:
+            summaries[user_id] = summary
+            del pending_dropped[user_id][:len(dropped)]
+    except Exception as e:
+        logger.error(f'summary failed for {user_id}: {e}')
+    finally:
+        with summary_lock:
+            summarizing.discard(user_id)
+
+
+def build_prompt(user_id):
+    """組出推論用 prompt：固定的 system 區塊永遠在最前面，之後才是摘要與對話歷史
+
+    system 區塊逐字不變（不含 user_id、時間戳等動態內容），
+    跨請求的 prompt 前綴才對得上 KV cache。
+    還沒被背景摘要消化的舊訊息先以原文帶上，不會漏掉上下文。
+    """
+    system_prompt = memory.get(user_id)[0]['content']
+    parts = [system_prompt]
+    with summary_lock:
+        summary = summaries[user_id]
+        pending = [m['content'] for m in pending_dropped[user_id]]
+    if summary:
+        parts.append(f'先前對話摘要：{summary}')
+    if pending:
+        parts.append("\n".join(pending))
+    parts.append(memory.get_joined(user_id))
+    return "\n\n".join(parts)
 
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    # 整包 webhook body 可能是好幾 KB 的 JSON，只在 DEBUG 時才寫進 log
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug("Request body: %s", body)
     try:
         handler.handle(body, signature)
     except InvalidSignatureError:
@@ -50,25 +235,51 @@ def callback():
         abort(400)
     return 'OK'
 
+def push_final_reply(user_id, future):
+    """生成結束後把完整回答 push 給使用者"""
+    try:
+        response = future.result().strip()
+        cleaned_response = s2t_converter.convert(response)
+        pending_dropped[user_id] += memory.append(user_id, "assistant", cleaned_response)
+        msg = TextSendMessage(text=cleaned_response)
+    except Exception as e:
+        msg = TextSendMessage(text=f'⚠️ 發生錯誤：{str(e)}')
+    try:
+        line_bot_api.push_message(user_id, msg)
+    except Exception as e:
+        # push 額度用罄、被封鎖或網路錯誤：使用者已拿到佔位訊息，至少留下紀錄
+        logger.error(f'push failed for {user_id}: {e}')
+
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_text_message(event):
     user_id = event.source.user_id
     text = event.message.text.strip()
     logger.info(f'{user_id}: {text}')
     try:
-        memory.append(user_id, "user", text)
+        pending_dropped[user_id] += memory.append(user_id, "user", text)
+        if pending_dropped[user_id]:
+            # 摘要在背景慢慢併，這一輪 prompt 先帶滑出視窗的原文
+            push_pool.submit(update_summary, user_id)
+
+        # 將聊天歷史轉為 prompt（視窗外的舊對話以摘要帶入）
+        full_prompt = build_prompt(user_id)
+
+        # 丟進 batcher 排隊，與其他使用者的訊息合併成一個 batch 推論
+        future = batcher.submit((user_id, full_prompt))
 
-        # 將聊天歷史轉為 prompt
-        prompt = "\n".join([m["content"] for m in memory.get(user_id)])
-        full_prompt = f"{DEFAULT_SYSTEM_MESSAGE}\n\n{prompt}"
+        if STREAMING_REPLY:
+            # 馬上回佔位訊息降低體感延遲，完整回答之後再 push
+            # （push 丟進 pool 執行，避免卡住 batcher 的 worker thread）
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=THINKING_MESSAGE))
+            future.add_done_callback(lambda f: push_pool.submit(push_final_reply, user_id, f))
+            return
 
-        # 呼叫 Hugging Face 模型
-        result = chat_model(full_prompt)[0]['generated_text']
-        # 去掉原本 prompt，保留模型回答部分
-        response = result.replace(full_prompt, "").strip()
-        role, cleaned_response = get_role_and_content(response)
+        # generate 只回傳新生成的 token，不需再從結果中去除 prompt
+        response = future.result(timeout=60).strip()
+        cleaned_response = s2t_converter.convert(response)
 
-        memory.append(user_id, role, cleaned_response)
+        pending_dropped[user_id] += memory.append(user_id, "assistant", cleaned_response)
         msg = TextSendMessage(text=cleaned_response)
 
     except Exception as e:
@@ -82,9 +293,8 @@ def home():
 
 if __name__ == "__main__":
     try:
-        data = storage.load()
-        for user_id in data.keys():
-            pass  # 暫時不需要載入舊模型資料，因為 Hugging Face 不需要 token 註冊
+        # 只在啟動時讀一次舊資料進快取
+        storage.load()
     except FileNotFoundError:
         pass
     app.run(host='0.0.0.0', port=8080)
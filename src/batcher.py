@@ -0,0 +1,53 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class DynamicBatcher:
+    """將同時進來的多個 prompt 動態合併成一個 batch 再送進模型
+
+    webhook handler 透過 submit() 把 prompt 丟進佇列並拿到 Future，
+    背景 worker 會在 max_batch_delay 秒內收集最多 max_batch_size 筆，
+    一次呼叫 generate_fn 後把結果逐一填回對應的 Future。
+    generate_fn 可以替個別項目回傳 Exception 物件，該筆會以
+    set_exception 回報而不影響同批其他項目；generate_fn 整個 raise
+    時（例如單一 model.generate 失敗）整批才會一起收到例外。
+    """
+
+    def __init__(self, generate_fn, max_batch_size=8, max_batch_delay=0.04):
+        self.generate_fn = generate_fn
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, prompt) -> Future:
+        future = Future()
+        self.queue.put((prompt, future))
+        return future
+
+    def _drain(self):
+        prompt, future = self.queue.get()
+        batch = [(prompt, future)]
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get(timeout=self.max_batch_delay))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._drain()
+            prompts = [prompt for prompt, _ in batch]
+            try:
+                results = self.generate_fn(prompts)
+                for (_, future), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
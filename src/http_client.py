@@ -0,0 +1,44 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+
+
+class PooledRequestsHttpClient(RequestsHttpClient):
+    """共用一個 requests.Session 的 LINE HTTP client
+
+    預設的 RequestsHttpClient 每次呼叫都走 requests.get/post，
+    等於每個回覆都重新做一次 TCP + TLS 握手；
+    改用 Session + connection pool 讓連線可以重用。
+    """
+
+    def __init__(self, timeout=RequestsHttpClient.DEFAULT_TIMEOUT, pool_maxsize=20):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        response = self.session.get(url, headers=headers, params=params, stream=stream, timeout=timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        response = self.session.post(url, headers=headers, data=data, timeout=timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        response = self.session.delete(url, headers=headers, data=data, timeout=timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        response = self.session.put(url, headers=headers, data=data, timeout=timeout)
+        return RequestsHttpResponse(response)
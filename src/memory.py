@@ -19,6 +19,7 @@ class Memory(MemoryInterface):
         self.system_messages = defaultdict(str)
         self.default_system_message = system_message
         self.memory_message_count = memory_message_count
+        self._joined_cache = {}
 
     def _initialize(self, user_id: str):
         self.storage[user_id] = [{
@@ -26,25 +27,42 @@ class Memory(MemoryInterface):
         }]
 
     def _drop_message(self, user_id: str):
+        """超出視窗時截斷歷史，回傳被丟棄的訊息讓呼叫端做摘要"""
         if len(self.storage.get(user_id)) >= (self.memory_message_count + 1) * 2 + 1:
-            return [self.storage[user_id][0]] + self.storage[user_id][-(self.memory_message_count * 2):]
-        return self.storage.get(user_id)
+            dropped = self.storage[user_id][1:-(self.memory_message_count * 2)]
+            self.storage[user_id] = [self.storage[user_id][0]] + self.storage[user_id][-(self.memory_message_count * 2):]
+            return dropped
+        return []
 
     def change_system_message(self, user_id, system_message):
         self.system_messages[user_id] = system_message
         self.remove(user_id)
 
-    def append(self, user_id: str, role: str, content: str) -> None:
+    def append(self, user_id: str, role: str, content: str) -> list:
         if self.storage[user_id] == []:
             self._initialize(user_id)
         self.storage[user_id].append({
             'role': role,
             'content': content
         })
-        self._drop_message(user_id)
+        dropped = self._drop_message(user_id)
+        if dropped or user_id not in self._joined_cache:
+            # 歷史被截斷時整串重建，下次 get_joined 再算
+            self._joined_cache.pop(user_id, None)
+        else:
+            joined = self._joined_cache[user_id]
+            self._joined_cache[user_id] = content if joined == "" else f'{joined}\n{content}'
+        return dropped
 
     def get(self, user_id: str) -> str:
         return self.storage[user_id]
 
+    def get_joined(self, user_id: str) -> str:
+        """system 之後的訊息內容以換行串接；逐次 append 增量維護，不必每輪重建"""
+        if user_id not in self._joined_cache:
+            self._joined_cache[user_id] = "\n".join(m['content'] for m in self.storage[user_id][1:])
+        return self._joined_cache[user_id]
+
     def remove(self, user_id: str) -> None:
         self.storage[user_id] = []
+        self._joined_cache.pop(user_id, None)
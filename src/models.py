@@ -17,9 +17,9 @@ class ModelInterface:
 
 
 class OpenAIModel(ModelInterface):
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, base_url: str = 'https://api.openai.com/v1'):
         self.api_key = api_key
-        self.base_url = 'https://api.openai.com/v1'
+        self.base_url = base_url
 
     def _request(self, method, endpoint, body=None, files=None):
         self.headers = {
@@ -49,12 +49,18 @@ class OpenAIModel(ModelInterface):
         }
         return self._request('POST', '/chat/completions', body=json_body)
 
-    def audio_transcriptions(self, file_path, model_engine) -> str:
-        files = {
-            'file': open(file_path, 'rb'),
-            'model': (None, model_engine),
-        }
-        return self._request('POST', '/audio/transcriptions', files=files)
+    def audio_transcriptions(self, file, model_engine) -> str:
+        # 可直接收 file-like 物件（例如 SpooledTemporaryFile），不必先落地成暫存檔
+        if hasattr(file, 'read'):
+            return self._request('POST', '/audio/transcriptions', files={
+                'file': file,
+                'model': (None, model_engine),
+            })
+        with open(file, 'rb') as f:
+            return self._request('POST', '/audio/transcriptions', files={
+                'file': f,
+                'model': (None, model_engine),
+            })
 
     def image_generations(self, prompt: str) -> str:
         json_body = {
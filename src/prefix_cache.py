@@ -0,0 +1,46 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class PrefixKVCache:
+    """以 user_id 為 key 快取上一輪 prompt 的 KV cache
+
+    同一位使用者的下一則訊息 prompt 會以上一輪的 prompt 開頭，
+    命中時只需要 prefill 新增的部分，而不是整段對話歷史。
+    只快取 prompt 部分的 token（生成的回覆經過轉換後重新 tokenize
+    不會與生成序列一致），且命中即取出：generate 會就地延長
+    past_key_values，留在快取裡會變成與 token 序列對不上的髒資料。
+    每筆 KV 都佔 GPU 記憶體，max_entries 不宜開大。
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def match(self, user_id, input_ids):
+        """若快取的 token 序列是 input_ids 的前綴，取出並回傳對應的 past_key_values"""
+        with self._lock:
+            entry = self._entries.pop(user_id, None)
+            if entry is None:
+                return None
+            cached_ids, past = entry
+            cached_len = cached_ids.shape[1]
+            if cached_len < input_ids.shape[1] and torch.equal(input_ids[:, :cached_len], cached_ids):
+                return past
+            return None
+
+    def put(self, user_id, input_ids, past):
+        if past is None:
+            return
+        with self._lock:
+            self._entries[user_id] = (input_ids, past)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
@@ -1,5 +1,6 @@
 import os
 import re
+from functools import lru_cache
 import requests
 from bs4 import BeautifulSoup
 
@@ -23,18 +24,30 @@ WEBSITE_MESSAGE_FORMAT = """
 """
 
 
+# 模組載入時就編譯好，避免每個 webhook 重新 compile
+URL_REGEX = re.compile(r'^https?://\S+')
+
+
+# 只快取成功抓到的頁面；失敗會 raise，lru_cache 不會記住例外，
+# 暫時性的 4xx/5xx 才不會被永久快取成空結果
+@lru_cache(maxsize=512)
+def _fetch_content(url):
+    hotpage = requests.get(url)
+    hotpage.raise_for_status()
+    return hotpage.text
+
+
 class Website:
     def get_url_from_text(self, text: str):
-        url_regex = re.compile(r'^https?://\S+')
-        match = re.search(url_regex, text)
+        match = URL_REGEX.search(text)
         if match:
             return match.group()
         else:
             return None
 
     def get_content_from_url(self, url: str):
-        hotpage = requests.get(url)
-        main = BeautifulSoup(hotpage.text, 'html.parser')
+        # 同一個連結被不同使用者轉貼時，直接重用抓好的內容
+        main = BeautifulSoup(_fetch_content(url), 'html.parser')
         chunks = [article.text.strip() for article in main.find_all('article')]
         if chunks == []:
             chunks = [article.text.strip() for article in main.find_all('div', class_='content')]
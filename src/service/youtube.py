@@ -1,6 +1,7 @@
 import math
 import os
 import re
+from functools import lru_cache
 from src.utils import get_role_and_content
 
 from youtube_transcript_api import YouTubeTranscriptApi, NoTranscriptFound, TranscriptsDisabled
@@ -14,6 +15,16 @@ PART {} END
 WHOLE_MESSAGE_FORMAT = "下面是每一個部分的小結論：\"\"\"{}\"\"\" \n\n 請給我全部小結論的總結，字數約 100 字左右"
 SINGLE_MESSAGE_FORMAT = "下面是一個 Youtube 影片的字幕： \"\"\"{}\"\"\" \n\n請總結出這部影片的重點與一些細節，字數約 100 字左右"
 
+# 模組載入時就編譯好，避免每個 webhook 重新 compile
+VIDEO_ID_REGEX = re.compile(r'(?:youtube\.com\/(?:[^\/]+\/.+\/|(?:v|e(?:mbed)?)\/|.*[?&]v=)|youtu\.be\/)([a-zA-Z0-9_-]{11})')
+
+
+# 只快取成功抓到的字幕；失敗會 raise，lru_cache 不會記住例外，
+# 暫時性的網路錯誤才不會被永久快取成錯誤結果
+@lru_cache(maxsize=512)
+def _fetch_transcript(video_id):
+    return YouTubeTranscriptApi.get_transcript(video_id, languages=['zh-TW', 'zh', 'ja', 'zh-Hant', 'zh-Hans', 'en', 'ko'])
+
 
 class Youtube:
     def __init__(self, step):
@@ -22,7 +33,8 @@ class Youtube:
 
     def get_transcript_chunks(self, video_id):
         try:
-            transcript = YouTubeTranscriptApi.get_transcript(video_id, languages=['zh-TW', 'zh', 'ja', 'zh-Hant', 'zh-Hans', 'en', 'ko'])
+            # 同一部影片被不同使用者轉貼時，直接重用抓好的字幕
+            transcript = _fetch_transcript(video_id)
             text = [t.get('text') for i, t in enumerate(transcript) if i % self.step == 0]
             chunks = ['\n'.join(text[i*self.chunk_size: (i+1)*self.chunk_size]) for i in range(math.ceil(len(text) / self.chunk_size))]
         except NoTranscriptFound:
@@ -34,8 +46,7 @@ class Youtube:
         return True, chunks, None
 
     def retrieve_video_id(self, url):
-        regex = r'(?:youtube\.com\/(?:[^\/]+\/.+\/|(?:v|e(?:mbed)?)\/|.*[?&]v=)|youtu\.be\/)([a-zA-Z0-9_-]{11})'
-        match = re.search(regex, url)
+        match = VIDEO_ID_REGEX.search(url)
         if match:
             return match.group(1)
         else:
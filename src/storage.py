@@ -1,4 +1,8 @@
 import json
+import os
+import sqlite3
+import tempfile
+import threading
 import datetime
 
 
@@ -9,8 +13,12 @@ class FileStorage:
 
     def save(self, data):
         self.history.update(data)
-        with open(self.fine_name, 'w', newline='') as f:
+        # 先寫到暫存檔再 os.replace，避免寫到一半當機留下壞掉的 JSON
+        dir_name = os.path.dirname(self.fine_name) or '.'
+        fd, tmp_name = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+        with os.fdopen(fd, 'w', newline='') as f:
             json.dump(self.history, f)
+        os.replace(tmp_name, self.fine_name)
 
     def load(self):
         with open(self.fine_name, newline='') as jsonfile:
@@ -19,6 +27,34 @@ class FileStorage:
         return self.history
 
 
+class SQLiteStorage:
+    """單檔 SQLite 儲存，WAL 模式下每次 save 只寫異動的那筆
+
+    FileStorage 每次 save 都重寫整個 JSON 檔，使用者一多就是 O(n) 磁碟寫入；
+    這裡改成 INSERT OR REPLACE，寫入成本與使用者數無關。
+    """
+
+    def __init__(self, file_name):
+        self.conn = sqlite3.connect(file_name, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS api_key (user_id TEXT PRIMARY KEY, api_key TEXT)')
+        self.conn.commit()
+        self._lock = threading.Lock()
+
+    def save(self, data):
+        with self._lock:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO api_key (user_id, api_key) VALUES (?, ?)',
+                list(data.items())
+            )
+            self.conn.commit()
+
+    def load(self):
+        with self._lock:
+            rows = self.conn.execute('SELECT user_id, api_key FROM api_key').fetchall()
+        return {user_id: api_key for user_id, api_key in rows}
+
+
 class MongoStorage:
     def __init__(self, db):
         self.db = db